@@ -1,5 +1,6 @@
 import argparse
 import hashlib
+import html
 import http.server
 import json
 import logging
@@ -11,31 +12,76 @@ import sqlite3
 import sys
 import webbrowser
 from datetime import datetime
-from functools import partial
-from itertools import product
+from itertools import accumulate, product
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-import segno
-from jinja2 import Environment, FileSystemLoader
-from lxml import etree
 
-    
-def username_to_md5(username: str) -> str:
-    return hashlib.md5(username.encode('utf-8')).hexdigest()
 
-def parse_blob(blob, regex):
-    matches = re.findall(regex, blob)
-    if len(matches) > 0:
-        result = matches[0].decode()
-    else:
-        result = None
-    return result
+EMOJI_MD5_RE = re.compile(r'<emoji\b[^>]*\bmd5\s*=\s*"([^"]*)"')
+EMOJI_URL_RE = re.compile(r'<emoji\b[^>]*\bcdnurl\s*=\s*"([^"]*)"')
+TITLE_RE = re.compile(r'<title>([^<]*)</title>')
+MEMBER_RE = re.compile(r'<Member\b[^>]*\bUserName="([^"]+)"')
+WXID_RE = re.compile(r"[0-9A-Za-z_\-]{6,20}")
+# 以下匹配经latin-1解码的二进制字段，字节与字符一一对应
+HEADIMG_RE = re.compile(r"(https?://.*?/.*?/(?:.*?/)?.*?/\d+)")
+FOUNDER_RE = re.compile(r"\x12.([0-9A-Za-z_\-]{6,20})")
+CHATROOM_RE = re.compile(r"(<RoomData>.*</RoomData>)")
+PROFILE_RE = re.compile(r"\x08([\x00-\x02])")
+
+def usernames_to_md5(usernames) -> list:
+    md5 = hashlib.md5
+    return [md5(username.encode('utf-8')).hexdigest() for username in usernames]
+
+def username_to_md5(username: str) -> str:
+    return usernames_to_md5([username])[0]
+
+def extract_blob(blobs: pd.Series, pattern: re.Pattern) -> pd.Series:
+    return blobs.str.decode("latin-1").str.extract(pattern, expand=False)
+
+def scan_tlv(buf: bytes, offsets: list):
+    rows, dtypes, starts, lengths = [], [], [], []
+    for row in range(len(offsets) - 1):
+        csor, end = offsets[row], offsets[row + 1]
+        while csor + 1 < end:
+            step = buf[csor + 1]
+            rows.append(row)
+            dtypes.append(buf[csor])
+            starts.append(csor + 2)
+            lengths.append(min(step, end - csor - 2))
+            csor += 2 + step
+    return rows, dtypes, starts, lengths
+
+def parse_remark(blobs: pd.Series) -> pd.DataFrame:
+    blobs_list = [blob or b"" for blob in blobs]
+    raw = b"".join(blobs_list)
+    offsets = list(accumulate(map(len, blobs_list), initial=0))
+    rows, dtypes, starts, lengths = scan_tlv(raw, offsets)
+    fields = pd.DataFrame({
+        "row": rows,
+        "dtype": dtypes,
+        "value": [raw[s:s+l].decode() for s, l in zip(starts, lengths)],
+    })
+    fields = (
+        fields.drop_duplicates(["row", "dtype"], keep="last")
+              .pivot(index="row", columns="dtype", values="value")
+              .reindex(range(len(blobs_list)))
+              .rename_axis(index=None, columns=None)
+    )
+    fields.index = blobs.index
+    return fields
+
+_XML_PARSER = None
 
 def parse_xml_msg(msg, path='appmsg/type', attr=None):
+    global _XML_PARSER
+    from lxml import etree
+    if _XML_PARSER is None:
+        # 指定parser，且尝试解析有误的XML；首次调用时创建并复用
+        _XML_PARSER = etree.XMLParser(remove_blank_text=True, recover=True)
     try:
-        # 指定parser，且尝试解析有误的XML
-        xml = etree.XML(msg, parser=etree.XMLParser(remove_blank_text=True, recover=True))
+        xml = etree.XML(msg, parser=_XML_PARSER)
         ele = xml.xpath(path)[0]
         t = ele.get(attr) if attr else ele.text
         if t == '':
@@ -44,6 +90,26 @@ def parse_xml_msg(msg, path='appmsg/type', attr=None):
         t = None
     return t
 
+def extract_xml(msgs: pd.Series, pattern: re.Pattern, path: str, attr=None) -> pd.Series:
+    values = msgs.str.extract(pattern, expand=False).replace("", np.nan).map(html.unescape, na_action="ignore")
+    # 正则未命中（如CDATA、单引号属性）时回退到XML解析
+    missed = values.isna()
+    values.loc[missed] = msgs[missed].apply(parse_xml_msg, path=path, attr=attr)
+    return values
+
+def connect_db(path) -> sqlite3.Connection:
+    # 备份文件不会被改动，以只读且immutable方式打开可跳过锁与日志检查
+    uri = Path(path).absolute().as_uri() + "?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True)
+    # 仅做只读查询，加大页缓存并启用内存映射
+    conn.executescript("""
+        PRAGMA mmap_size = 268435456;
+        PRAGMA cache_size = -65536;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA query_only = 1;
+    """)
+    return conn
+
 def pause_for_exit():
     input("Press <ENTER> to exit")
     sys.exit()
@@ -83,11 +149,12 @@ class WeChat:
         self.year = now.year - 1 if now.month < 3 else now.year
         self.st = datetime(self.year,1,1).timestamp()
         self.et = datetime(self.year+1,1,1).timestamp()
+        self.message_conns = {}
 
     def prepare_wxfile(self):
         logger.debug("Searching manifest for WeChat files")
         try:
-            with sqlite3.connect(self.backup / "Manifest.db") as conn:
+            with connect_db(self.backup / "Manifest.db") as conn:
                 wxfile = pd.read_sql("""
                     SELECT relativePath, fileID
                     FROM Files
@@ -97,22 +164,24 @@ class WeChat:
             logger.error("WeChat files not found!")
             pause_for_exit()
         else:
-            self.wxfile = wxfile
+            self.path_to_id = dict(zip(wxfile["relativePath"], wxfile["fileID"]))
 
     def get_file_by_id(self, file_id: str) -> Path:
         file_path = self.backup / file_id[:2] / file_id
         return file_path
 
     def get_file_by_path(self, path: str) -> Path:
-        file_id = self.wxfile[self.wxfile["relativePath"]==path]["fileID"].iat[0]
+        file_id = self.path_to_id[path]
         file_path = self.get_file_by_id(file_id)
         return file_path
         
     def prepare_myself_info(self):
         logger.debug("Parsing self account info")
-        mmptn = "^Documents/MMappedKV/mmsetting.archive.[0-9A-Za-z_\-]{6,20}$"
-        wxmm = self.wxfile[self.wxfile["relativePath"].str.match(mmptn)]["relativePath"]
-        mymmp = wxmm.iat[0]
+        mmprefix = "Documents/MMappedKV/mmsetting.archive."
+        mymmp = next(
+            p for p in self.path_to_id
+            if p.startswith(mmprefix) and WXID_RE.fullmatch(p[len(mmprefix):])
+        )
         self.myid = mymmp.split(".")[-1]
         self.mymd5 = username_to_md5(self.myid)
         try:
@@ -129,7 +198,7 @@ class WeChat:
         logger.debug("Parsing WeChat contacts")
         contact_db = self.get_file_by_path("Documents/{}/DB/WCDB_Contact.sqlite".format(self.mymd5))
 
-        with sqlite3.connect(contact_db) as conn:
+        with connect_db(contact_db) as conn:
             friends = pd.read_sql("""
                 SELECT userName, type, dbContactRemark, dbContactHeadImage, dbContactProfile
                 FROM Friend
@@ -152,28 +221,12 @@ class WeChat:
             66: "tag",
         }
 
-        def parse_remark(blob):
-            csor, data = 0, {}
-            while csor < len(blob):
-                dtype = blob[csor]
-                csor += 1
-                step = blob[csor]
-                csor += 1
-                data[dtype] = blob[csor:csor+step].decode()
-                csor += step
-            return pd.Series(data).rename(remark_fields)
-
-        parse_headimg = partial(parse_blob, regex=b"https?://.*?/.*?/(?:.*?/)?.*?/\d+")
-        parse_founder = partial(parse_blob, regex=b"\x12.([0-9A-Za-z_\-]{6,20})")
-        parse_chatroom = partial(parse_blob, regex=b"<RoomData>.*</RoomData>")
-        parse_profile = partial(parse_blob, regex=b"\x08([\x00-\x02])")
-
         try:
             logger.debug("Parsing friends out of contacts")
-            friends = friends.join(friends["dbContactRemark"].apply(parse_remark))
-            friends["headimg"] = friends["dbContactHeadImage"].map(parse_headimg)
-            friends["gender"] = friends["dbContactProfile"].map(parse_profile)
-            friends["table"] = "Chat_" + friends.index.map(username_to_md5)
+            friends = friends.join(parse_remark(friends["dbContactRemark"]).rename(columns=remark_fields))
+            friends["headimg"] = extract_blob(friends["dbContactHeadImage"], HEADIMG_RE)
+            friends["gender"] = extract_blob(friends["dbContactProfile"], PROFILE_RE)
+            friends["table"] = ["Chat_" + h for h in usernames_to_md5(friends.index)]
         except Exception as err:
             logger.warning(f"Failed due to {err}")
         else:
@@ -181,58 +234,123 @@ class WeChat:
 
         try:
             logger.debug("Parsing groups out of contacts")
-            groups = groups.join(groups["dbContactRemark"].apply(parse_remark))
-            groups["founder"] = groups["dbContactChatRoom"].map(parse_founder)
-            groups["chatroom"] = groups["dbContactChatRoom"].map(parse_chatroom)
-            groups["table"] = "Chat_" + groups.index.map(username_to_md5)
+            groups = groups.join(parse_remark(groups["dbContactRemark"]).rename(columns=remark_fields))
+            groups["founder"] = extract_blob(groups["dbContactChatRoom"], FOUNDER_RE)
+            groups["chatroom"] = extract_blob(groups["dbContactChatRoom"], CHATROOM_RE).str.encode("latin-1").str.decode("utf-8")
+            groups["table"] = ["Chat_" + h for h in usernames_to_md5(groups.index)]
         except Exception as err:
             logger.warning(f"Failed due to {err}")
         else:
             self.groups = groups.drop(columns=groups.filter(like="dbContact").columns)
 
+    def get_message_conn(self, message_db: Path) -> sqlite3.Connection:
+        # 每个消息库只连接一次，查表、统计与读消息共用
+        if message_db not in self.message_conns:
+            self.message_conns[message_db] = connect_db(message_db)
+        return self.message_conns[message_db]
+
+    def close_message_conn(self):
+        for conn in self.message_conns.values():
+            conn.close()
+        self.message_conns = {}
+
     def get_message_table(self, message_db: Path):
-        with sqlite3.connect(message_db) as conn:
-            tables = pd.read_sql(
-                "SELECT * FROM sqlite_sequence", conn
-            ).assign(**{"message_db": message_db})
+        tables = pd.read_sql(
+            "SELECT * FROM sqlite_sequence", self.get_message_conn(message_db)
+        ).assign(**{"message_db": message_db})
         return tables
 
-    def get_message_by_id(self, id, contact):
-        database = contact.at[id, "message_db"]
-        table = contact.at[id, "table"]
-        sql = f"""
-            SELECT *
-            FROM {table}
-            WHERE CreateTime >= {self.st} AND CreateTime < {self.et}
-        """
-        try:
-            with sqlite3.connect(database) as conn:
-                msg = pd.read_sql(sql, conn)
-        except:
-            msg = pd.DataFrame()
-        return msg
-
-    def get_message(self):
-        logger.debug("Reading messages")
-        message_db_paths = self.wxfile["relativePath"].str.extract(f"(^Documents/{self.mymd5}/DB/message_\d+.sqlite$)")[0].dropna()
+    def prepare_message_table(self):
+        logger.debug("Searching message tables")
+        dbprefix = f"Documents/{self.mymd5}/DB/message_"
+        message_db_paths = sorted(
+            p for p in self.path_to_id
+            if p.startswith(dbprefix) and p.endswith(".sqlite") and p[len(dbprefix):-len(".sqlite")].isdigit()
+        )
         message_tables = pd.concat([
             self.get_message_table(self.get_file_by_path(db_path))
             for db_path in message_db_paths
         ], axis=0)
-        friends = self.friends.join(message_tables.set_index("name"), on="table")
-        groups = self.groups.join(message_tables.set_index("name"), on="table")
+        contact_tables = pd.concat([self.friends["table"], self.groups["table"]])
+        self.message_tables = message_tables[message_tables["name"].isin(contact_tables)]
+
+    def get_message_by_db(self, message_db: Path, tables, select: str):
+        # SQLite caps compound SELECTs at 500 terms by default
+        conn = self.get_message_conn(message_db)
+        msgs = []
+        for i in range(0, len(tables), 500):
+            chunk = tables[i:i+500]
+            sql = " UNION ALL ".join(
+                select.format(table=table, st=self.st, et=self.et)
+                for table in chunk
+            )
+            try:
+                msgs.append(pd.read_sql(sql, conn))
+            except Exception as err:
+                # 单表出错时逐表重试，避免整批会话丢失
+                logger.warning(f"Failed reading {message_db} due to {err}. Retrying table by table")
+                for table in chunk:
+                    try:
+                        msgs.append(pd.read_sql(select.format(table=table, st=self.st, et=self.et), conn))
+                    except Exception as err:
+                        logger.warning(f"Failed reading {table} due to {err}")
+        return msgs
+
+    def split_message(self, msg, contact):
+        table_to_user = dict(zip(contact["table"], contact.index))
+        msg = msg.assign(userName=msg["_table"].map(table_to_user)).dropna(subset=["userName"])
+        msg = msg.set_index(["userName", msg.groupby("userName").cumcount()])
+        return msg.drop(columns="_table")
+
+    def query_message(self, select: str):
+        msgs = [
+            m
+            for db, tables in self.message_tables.groupby("message_db")
+            for m in self.get_message_by_db(db, tables["name"].to_list(), select)
+        ]
+        # 空结果的列为object类型，参与拼接会使整列升格为object
+        msg = pd.concat([m for m in msgs if not m.empty] or msgs, ignore_index=True)
+        return self.split_message(msg, self.friends), self.split_message(msg, self.groups)
 
-        msg_friend = pd.concat({i: self.get_message_by_id(i, friends) for i, r in friends.iterrows()})
-        msg_group = pd.concat({i: self.get_message_by_id(i, groups) for i, r in groups.iterrows()})
-        msg_friend["dt"] = msg_friend["CreateTime"].map(datetime.fromtimestamp)
-        msg_group["dt"] = msg_group["CreateTime"].map(datetime.fromtimestamp)
+    def get_message(self):
+        logger.debug("Reading messages")
+        # 仅读取需逐条分析的消息：收到的文字、发出的表情与引用、新好友与新群聊
+        msg_friend, msg_group = self.query_message("""
+            SELECT Type, Des, MesSvrID, Message, '{table}' AS _table
+            FROM {table}
+            WHERE CreateTime >= {st} AND CreateTime < {et} AND (
+                (Type = 1 AND Des > 0)
+                OR (Type = 47 AND Des = 0)
+                OR (Type = 10000 AND MesSvrID = 0)
+                OR (Type = 10002 AND instr(Message, 'username') > 0 AND instr(Message, 'others') > 0)
+                OR (Type NOT IN (10000, 10002) AND Des = 0 AND instr(Message, 'refermsg') > 0)
+            )
+        """)
         msg_self = pd.concat([msg_friend[msg_friend["Des"]==0], msg_group[msg_group["Des"]==0]])
         return msg_self, msg_friend, msg_group
 
+    def get_message_stat(self):
+        logger.debug("Counting messages")
+        # 按会话、收发与日期汇总，文字消息字数去除首尾空白后计，空白字符与str.strip()一致
+        # 'localtime'逐条按当时的时区偏移换算，夏令时前后的日期与datetime.fromtimestamp一致
+        return self.query_message("""
+            SELECT '{table}' AS _table, Des,
+                   date(CreateTime, 'unixepoch', 'localtime') AS date,
+                   COUNT(*) AS Message,
+                   TOTAL(CASE WHEN Type = 1 THEN length(trim(Message, char(
+                       9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 133, 160, 5760,
+                       8192, 8193, 8194, 8195, 8196, 8197, 8198, 8199, 8200, 8201, 8202,
+                       8232, 8233, 8239, 8287, 12288
+                   ))) END) AS words
+            FROM {table}
+            WHERE CreateTime >= {st} AND CreateTime < {et}
+            GROUP BY Des, date
+        """)
+
     def get_session(self):
         try:
             session_db = self.get_file_by_path(f"Documents/{self.mymd5}/session/session.db")
-            with sqlite3.connect(session_db) as conn:
+            with connect_db(session_db) as conn:
                 sessions = pd.read_sql(f"""
                     SELECT * FROM SessionAbstract
                     WHERE CreateTime >= {self.st}
@@ -253,10 +371,15 @@ class WeChat:
             return output
         
         self.prepare_contact()
-        msg_self, msg_friend, msg_group = self.get_message()
+        try:
+            self.prepare_message_table()
+            stat_friend, stat_group = self.get_message_stat()
+            msg_self, msg_friend, msg_group = self.get_message()
+        finally:
+            self.close_message_conn()
 
         # 0. days
-        active_days = pd.concat([msg_group["dt"], msg_friend["dt"]]).dt.normalize().nunique()
+        active_days = pd.concat([stat_group["date"], stat_friend["date"]]).nunique()
         
         # 1. sessions
         sessions = self.get_session()
@@ -265,42 +388,45 @@ class WeChat:
         session_count_friend = int(sessions["UsrName"].isin(self.friends.index).sum())
 
         # 2. self messages
-        message_count = len(msg_self)
-        message_word_count = int(
-            msg_self[msg_self["Type"]==1]["Message"].str.strip().str.len().sum() +
-            msg_self[msg_self["Message"].str.contains("refermsg")]["Message"].apply(parse_xml_msg, path="appmsg/title").str.len().sum()
-        )
+        stat_self = pd.concat([stat_friend[stat_friend["Des"]==0], stat_group[stat_group["Des"]==0]])
+        message_count_friend = int(stat_friend[stat_friend["Des"]==0]["Message"].sum())
+        message_count_group = int(stat_group[stat_group["Des"]==0]["Message"].sum())
+        message_count = message_count_friend + message_count_group
+        refer_mask = msg_self["Message"].str.contains("refermsg", regex=False, na=False)
+        refer_title = extract_xml(msg_self.loc[refer_mask, "Message"], TITLE_RE, path="appmsg/title")
+        message_word_count = int(stat_self["words"].sum() + refer_title.str.len().sum())
 
         # 3. emojis
         msg_self_emoji = msg_self[msg_self["Type"]==47]["Message"].rename_axis(["chat", "idx"]).reset_index()
-        msg_self_emoji["md5"] = msg_self_emoji["Message"].apply(parse_xml_msg, path="emoji", attr="md5")
-        msg_self_emoji["url"] = msg_self_emoji["Message"].apply(parse_xml_msg, path="emoji", attr="cdnurl")
+        msg_self_emoji["md5"] = extract_xml(msg_self_emoji["Message"], EMOJI_MD5_RE, path="emoji", attr="md5")
+        msg_self_emoji["url"] = extract_xml(msg_self_emoji["Message"], EMOJI_URL_RE, path="emoji", attr="cdnurl")
         emoji_url = msg_self_emoji[["md5", "url"]].dropna().drop_duplicates("md5").set_index("md5")
         msg_self_emoji_rank = (
             msg_self_emoji.groupby("md5").agg({"Message": "count", "chat": "nunique"})
-                        .sort_values(["Message", "chat"], ascending=False)
-                        .join(emoji_url, how="inner").head(10)
+                        .join(emoji_url, how="inner")
+                        .nlargest(10, ["Message", "chat"])
         )
         
         # 4. new friends
         friends_new = msg_friend[(msg_friend["Type"]==10000)&(msg_friend["MesSvrID"]==0)&(~msg_friend["Message"].str.contains("\""))]
         groups_new = msg_group[(msg_group["Type"]==10002)&(msg_group["Message"].str.contains("username.*others"))]
-        connections_new = groups_new.droplevel(1).join(self.groups)["chatroom"].apply(lambda x: pd.read_xml(x, xpath="Member")["UserName"].to_list()).explode().nunique()
+        connections_new = groups_new.droplevel(1).join(self.groups)["chatroom"].str.findall(MEMBER_RE).explode().nunique()
 
         # 5. friends
-        msg_friend_agg = msg_friend.groupby(level=0).agg({
-            "Message": "count", "dt": lambda s: s.dt.normalize().nunique()
-        }).sort_values(["dt", "Message"], ascending=False).head(20).join(self.friends)
+        msg_friend_agg = stat_friend.groupby(level=0).agg(
+            Message=("Message", "sum"), dt=("date", "nunique")
+        ).nlargest(20, ["dt", "Message"]).join(self.friends)
 
         # 6. groups
-        msg_group_agg = msg_group.groupby(level=0)["Des"].value_counts().unstack().rename(columns={0: "send", 1: "receive"}).fillna(0)
+        msg_group_agg = stat_group.groupby(["userName", "Des"])["Message"].sum().unstack().rename(columns={0: "send", 1: "receive"}).fillna(0)
         msg_group_agg["messages"] = msg_group_agg.sum(axis=1)
-        msg_group_agg = msg_group_agg.sort_values(["messages", "send"], ascending=False).head(10).join(self.groups)
+        msg_group_agg = msg_group_agg.nlargest(10, ["messages", "send"]).join(self.groups)
 
         # 7. clips
-        msg_strip = msg_friend["Message"].str.replace("(\[.{2,4}\])|\s+", "", regex=True)
+        msg_text = msg_friend[(msg_friend["Type"]==1)&(msg_friend["Des"]>0)]["Message"]
+        msg_strip = msg_text.str.replace(r"(\[.{2,4}\])|\s+", "", regex=True)
         msg_len = msg_strip.str.len()
-        msg_clip = msg_strip[(msg_friend["Type"]==1)&(msg_len>8)&(msg_len<18)&(msg_friend["Des"]>0)]
+        msg_clip = msg_strip[(msg_len>8)&(msg_len<18)]
 
         output = {
             "myself": {
@@ -317,8 +443,8 @@ class WeChat:
                 },
                 "message": {
                     "count": message_count,
-                    "count_group": len(msg_group[msg_group["Des"]==0]),
-                    "count_friend": len(msg_friend[msg_friend["Des"]==0]),
+                    "count_group": message_count_group,
+                    "count_friend": message_count_friend,
                     "word_count": message_word_count
                 },
                 "emoji": [
@@ -373,6 +499,7 @@ def run_report():
     wx = WeChat()
     data = wx.output_data(workdir)
     logger.info("Generating run_report")
+    from jinja2 import Environment, FileSystemLoader
     static_folder = workdir / "static"
     envrionment = Environment(loader=FileSystemLoader(static_folder), trim_blocks=True, lstrip_blocks=True)
     template = envrionment.get_template("template.html")
@@ -381,6 +508,7 @@ def run_report():
     
     logger.info("Done! Scan the QR code to read your run_report")
     url = "http://{}:8000".format(get_lan_ip())
+    import segno
     qr = segno.make(url, version=2)
     qr_png = workdir / "qrcode.png"
     qr.save(qr_png.as_posix(), scale=10)